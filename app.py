@@ -1,14 +1,31 @@
 # app.py — WhatsApp Cloud API + SQLite + Google Sheets (Apps Script)
 
+# gevent debe parchear sockets/threads antes de importar httpx, ssl, etc.
+from gevent import monkey
+monkey.patch_all()
+
 import os
 import re
-import json
+import queue
+import atexit
 import sqlite3
+import threading
+import time
+import unicodedata
+from contextlib import contextmanager
+from pathlib import Path
+from functools import lru_cache
+from collections import OrderedDict, deque
+from itertools import groupby
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
 from datetime import datetime, timedelta, timezone
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 from zoneinfo import ZoneInfo
 from flask import Flask, request, jsonify
+from flask.json.provider import JSONProvider
 from dotenv import load_dotenv
-import requests
+import httpx
+import orjson
 
 load_dotenv()
 
@@ -22,88 +39,377 @@ TZ = ZoneInfo("America/New_York")  # zona horaria para cálculos
 # ======== GOOGLE SHEETS (Apps Script) ========
 GOOGLE_APPS_SCRIPT_URL = os.getenv("GOOGLE_APPS_SCRIPT_URL", "").strip()
 GOOGLE_APPS_SCRIPT_KEY = os.getenv("GOOGLE_APPS_SCRIPT_KEY", "").strip()
+SHEETS_FLUSH_INTERVAL = float(os.getenv("SHEETS_FLUSH_INTERVAL", "0.5"))  # segundos entre envíos del buffer
+# Filas por POST (y umbral de envío anticipado). 1 = el cuerpo de una sola fila que
+# entiende el Apps Script actual; subirlo solo con un Apps Script que acepte
+# {"rows": [...]}, o un script viejo responde 2xx y las filas se pierden.
+SHEETS_BATCH_SIZE = max(1, int(os.getenv("SHEETS_BATCH_SIZE", "1")))  # 0 o negativo dejaría al flusher en un bucle
+SHEETS_WAIT_TIMEOUT = 30     # espera máxima por el resultado de una fila encolada
+SHEETS_MAX_ATTEMPTS = 4      # intentos por lote (backoff exponencial entre ellos)
+SHEETS_BACKOFF = 0.5         # segundos antes del 2º intento; se duplica en cada uno
+SHEETS_RETRY_STATUS = {429, 503}  # rechazos sin fila escrita: seguros de reintentar
+
+# ======== HTTP (keep-alive compartido para Graph + Apps Script) ========
+# HTTP/2: los envíos concurrentes a un mismo host comparten una conexión TLS
+HTTP_TIMEOUT = httpx.Timeout(10.0, connect=3.0)
+# Apps Script (doPost + redirect) tarda más en frío: conserva los 15 s de lectura de antes
+SHEETS_TIMEOUT = httpx.Timeout(15.0, connect=3.0)
+HTTP = httpx.Client(
+    transport=httpx.HTTPTransport(
+        http2=True,
+        retries=2,  # reintenta fallos de conexión
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=50),
+    ),
+    timeout=HTTP_TIMEOUT,
+    follow_redirects=True,  # Apps Script responde con 302 a googleusercontent.com
+)
+HTTP_RETRY_STATUS = {429, 500, 502, 503, 504}
+HTTP_GET_ATTEMPTS = 3
+
+def http_get(url, **kwargs):
+    # GET idempotente: reintenta errores de red y 429/5xx con backoff exponencial
+    for attempt in range(HTTP_GET_ATTEMPTS):
+        if attempt:
+            time.sleep(0.25 * 2 ** (attempt - 1))
+        try:
+            r = HTTP.get(url, **kwargs)
+        except httpx.TransportError:
+            if attempt == HTTP_GET_ATTEMPTS - 1:
+                raise
+            continue
+        if r.status_code not in HTTP_RETRY_STATUS:
+            return r
+    return r
+
+# ======== TRABAJO EN SEGUNDO PLANO ========
+# Sheets y Graph son la parte lenta de cada mensaje; se envían fuera del request
+EXECUTOR = ThreadPoolExecutor(max_workers=16)
+WEBHOOK_MAX_PENDING = 256  # payloads de webhook en cola antes de responder 503
 
 # ======== FLASK ========
+class OrjsonProvider(JSONProvider):
+    # jsonify con orjson, igual que los payloads salientes a Graph/Apps Script
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # ======== DB (SQLite) ========
 DB_PATH = "expenses.db"
 
-def db_connect():
-    return sqlite3.connect(DB_PATH)
-
-def init_db():
-    conn = db_connect()
-    c = conn.cursor()
+# Se aplican a cada conexión (escritor + lector). cache_size es por conexión,
+# así que se mantiene en ~20 MB; el mmap sí se comparte vía el SO.
+# busy_timeout reemplaza cualquier reintento manual ante SQLITE_BUSY.
+SQLITE_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",  # con WAL: sin doble fsync por escritura
+    "PRAGMA cache_size=-20000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA mmap_size=268435456",
+)
+
+def db_connect(readonly=False):
+    # cached_statements: cada conexión reutiliza el plan de las consultas del hot path
+    if readonly:
+        # mode=ro: una conexión del pool de lectura no puede escribir ni tomar el lock
+        target = Path(DB_PATH).resolve().as_uri() + "?mode=ro"
+    else:
+        target = DB_PATH
+    conn = sqlite3.connect(target, check_same_thread=False, isolation_level=None,
+                           cached_statements=256, uri=readonly)
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+# Único escritor (CONN) compartido por todo el proceso; SQLite serializa las
+# escrituras de todos modos, así que el lock solo evita intercalarlas entre threads.
+# Es reentrante para que tx() pueda envolver helpers que ya lo toman.
+CONN = db_connect()
+DB_WRITE_LOCK = threading.RLock()
+
+@contextmanager
+def tx():
+    # varias escrituras en una sola transacción (un solo commit/fsync)
+    with DB_WRITE_LOCK:
+        CONN.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+            CONN.execute("COMMIT")
+        except BaseException:
+            CONN.execute("ROLLBACK")
+            raise
+
+class SQLiteConnectionPool:
+    # Conexiones de solo lectura, separadas de CONN: una lectura nunca ve una
+    # transacción del escritor a medio hacer ni espera DB_WRITE_LOCK.
+    def __init__(self, size):
+        self._pool = queue.Queue(maxsize=size)
+        for _ in range(size):
+            self._pool.put(db_connect(readonly=True))
+
+    @contextmanager
+    def conn(self):
+        c = self._pool.get()
+        try:
+            yield c
+        finally:
+            self._pool.put(c)
+
+# Con gevent todos los "threads" son greenlets de un solo hilo del SO y sqlite3 no
+# cede el control durante una consulta: nunca hay dos lecturas a la vez, así que
+# más conexiones solo sumarían ~20 MB de caché cada una sin ganar paralelismo.
+READ_POOL_SIZE = 1
+READ_POOL = SQLiteConnectionPool(READ_POOL_SIZE)
+
+# Montos en centavos enteros (amount_cents): SUM exactos y sin redondeos de float.
+TABLES = {
     # gastos
-    c.execute("""
-      CREATE TABLE IF NOT EXISTS expenses (
+    "expenses": """
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         user TEXT NOT NULL,
-        amount REAL NOT NULL,
+        amount_cents INTEGER NOT NULL,
         category_id INTEGER NOT NULL,
         category_name TEXT NOT NULL,
         ts_utc TEXT NOT NULL,
         ts_epoch INTEGER
-      )
-    """)
+    """,
     # ingresos
-    c.execute("""
-      CREATE TABLE IF NOT EXISTS deposits (
+    "deposits": """
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         user TEXT NOT NULL,
-        amount REAL NOT NULL,
+        amount_cents INTEGER NOT NULL,
         source TEXT NOT NULL,
         ts_utc TEXT NOT NULL,
         ts_epoch INTEGER
-      )
-    """)
+    """,
     # sesiones (persistencia de estado)
-    c.execute("""
-      CREATE TABLE IF NOT EXISTS sessions (
+    "sessions": """
         user TEXT PRIMARY KEY,
         state TEXT NOT NULL,
-        amount REAL
-      )
-    """)
-    conn.commit()
-    conn.close()
+        amount_cents INTEGER
+    """,
+}
+
+def init_db():
+    # journal_mode es persistente en el archivo; basta con fijarlo una vez
+    CONN.execute("PRAGMA journal_mode=WAL")
+    for table, columns in TABLES.items():
+        CONN.execute(f"CREATE TABLE IF NOT EXISTS {table} ({columns})")
 
 def ensure_ts_epoch_column():
-    conn = db_connect()
-    c = conn.cursor()
-    c.execute("PRAGMA table_info(expenses)")
-    cols = [row[1] for row in c.fetchall()]
+    cols = [row[1] for row in CONN.execute("PRAGMA table_info(expenses)").fetchall()]
     if "ts_epoch" not in cols:
         try:
-            c.execute("ALTER TABLE expenses ADD COLUMN ts_epoch INTEGER")
-            conn.commit()
+            with DB_WRITE_LOCK:
+                CONN.execute("ALTER TABLE expenses ADD COLUMN ts_epoch INTEGER")
         except Exception as e:
             print("ALTER TABLE expenses add ts_epoch failed:", e)
-    conn.close()
 
 def backfill_ts_epoch_from_ts_utc():
-    conn = db_connect()
-    c = conn.cursor()
-    c.execute("SELECT id, ts_utc FROM expenses WHERE ts_epoch IS NULL OR ts_epoch = ''")
-    rows = c.fetchall()
-    updated = 0
-    for rid, ts in rows:
+    # conversión en SQL: un solo UPDATE, sin parsear fila por fila en Python.
+    # strftime('%s') entiende el ISO con offset/Z que guarda save_expense.
+    with tx():
+        cur = CONN.execute("""
+            UPDATE expenses SET ts_epoch = CAST(strftime('%s', ts_utc) AS INTEGER)
+            WHERE (ts_epoch IS NULL OR ts_epoch = '') AND strftime('%s', ts_utc) IS NOT NULL
+        """)
+    if cur.rowcount > 0:
+        print(f"Backfilled ts_epoch rows: {cur.rowcount}")
+    for rid, ts in CONN.execute("SELECT id, ts_utc FROM expenses WHERE ts_epoch IS NULL OR ts_epoch = ''"):
+        print("Backfill parse error for id", rid, ts)
+
+# índices para los SUM por usuario / categoría / rango de ts_epoch
+INDEXES = {
+    "idx_expenses_user_cat_ts": "expenses(user, category_id, ts_epoch)",
+    # cubre el GROUP BY por categoría sobre un rango (y reemplaza a idx_expenses_user_ts)
+    "idx_expenses_user_ts_cat": "expenses(user, ts_epoch, category_id)",
+    "idx_deposits_user_ts": "deposits(user, ts_epoch)",
+}
+OBSOLETE_INDEXES = ("idx_expenses_user_ts",)
+
+def ensure_indexes():
+    # después de ensure_ts_epoch_column: bases viejas no tienen ts_epoch
+    existing = {row[0] for row in CONN.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    created = False
+    with DB_WRITE_LOCK:
+        for name in OBSOLETE_INDEXES:
+            CONN.execute(f"DROP INDEX IF EXISTS {name}")
+        for name, target in INDEXES.items():
+            if name not in existing:
+                CONN.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {target}")
+                created = True
+        # estadísticas para el planner: solo si hay índices nuevos (quedan en sqlite_stat1)
+        if created:
+            CONN.execute("ANALYZE")
+
+def migrate_amount_cents():
+    # v2: amount REAL -> amount_cents INTEGER. SQLite no cambia el tipo de una
+    # columna, así que se reconstruye la tabla (sus índices los recrea ensure_indexes).
+    # La revisión va dentro de la transacción (BEGIN IMMEDIATE): si otro proceso
+    # migra a la vez, este espera su COMMIT y ve la tabla ya convertida.
+    for table, columns in TABLES.items():
+        with tx():
+            cols = [row[1] for row in CONN.execute(f"PRAGMA table_info({table})").fetchall()]
+            if "amount_cents" in cols:
+                continue
+            new_cols = ", ".join("amount_cents" if c == "amount" else c for c in cols)
+            select = ", ".join("CAST(ROUND(amount * 100) AS INTEGER)" if c == "amount" else c for c in cols)
+            CONN.execute(f"CREATE TABLE {table}_v2 ({columns})")
+            CONN.execute(f"INSERT INTO {table}_v2 ({new_cols}) SELECT {select} FROM {table}")
+            CONN.execute(f"DROP TABLE {table}")
+            CONN.execute(f"ALTER TABLE {table}_v2 RENAME TO {table}")
+        print(f"Migrado {table}: amount -> amount_cents")
+
+# Versión del esquema guardada en el propio archivo (PRAGMA user_version). Al
+# importar solo se lee ese número: crear tablas, backfill e índices corren una vez
+# por base, no en cada arranque de worker. `flask --app app init-db` lo fuerza.
+SCHEMA_VERSION = 2
+
+def migrate_db():
+    init_db()
+    ensure_ts_epoch_column()
+    backfill_ts_epoch_from_ts_utc()
+    migrate_amount_cents()
+    ensure_indexes()
+    with DB_WRITE_LOCK:
+        CONN.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+def ensure_schema():
+    version = CONN.execute("PRAGMA user_version").fetchone()[0]
+    if version < SCHEMA_VERSION:
+        print(f"Migrando esquema SQLite {version} -> {SCHEMA_VERSION}")
+        migrate_db()
+
+@app.cli.command("init-db")
+def init_db_command():
+    migrate_db()
+    print(f"Base lista: {DB_PATH} (esquema v{SCHEMA_VERSION})")
+
+ensure_schema()
+
+# ======== ESCRITURA DIFERIDA (write-behind) ========
+# Un solo thread escritor vacía la cola y agrupa lo acumulado (hasta DB_BATCH_SIZE)
+# en una transacción con executemany: bajo carga, un fsync por lote y no por fila.
+# No espera a propósito: si la cola tiene una sola fila, se escribe enseguida.
+DB_BATCH_SIZE = 64
+_DB_QUEUE = queue.Queue()  # (sql, params, Future)
+
+def enqueue_write(sql, params):
+    fut = Future()
+    _DB_QUEUE.put((sql, params, fut))
+    return fut
+
+def _write_batch(batch):
+    try:
+        with tx():
+            # filas consecutivas con el mismo SQL van en un solo executemany (orden preservado)
+            for sql, items in groupby(batch, key=lambda item: item[0]):
+                rows = [params for _, params, _ in items]
+                key_col = COALESCE_KEY_COLUMN.get(sql)
+                if key_col is not None and len(rows) > 1:
+                    # upsert: solo cuenta la última fila de cada clave
+                    rows = list({row[key_col]: row for row in rows}.values())
+                CONN.executemany(sql, rows)
+    except Exception as e:
+        if len(batch) > 1:
+            # reintenta fila por fila para que una fila mala no tumbe el lote entero
+            for item in batch:
+                _write_batch([item])
+            return
+        print("DB write failed:", e)
+        batch[0][2].set_exception(e)
+        return
+    for _, _, fut in batch:
+        fut.set_result(None)
+
+def _drain_db_queue(first=None):
+    batch = [first] if first is not None else []
+    while len(batch) < DB_BATCH_SIZE:
         try:
-            dt = datetime.fromisoformat((ts or "").replace("Z", "+00:00"))
-            epoch = int(dt.timestamp())
-            c.execute("UPDATE expenses SET ts_epoch = ? WHERE id = ?", (epoch, rid))
-            updated += 1
-        except Exception as e:
-            print("Backfill parse error for id", rid, ts, e)
-    conn.commit()
-    conn.close()
-    if updated:
-        print(f"Backfilled ts_epoch rows: {updated}")
-
-init_db()
-ensure_ts_epoch_column()
-backfill_ts_epoch_from_ts_utc()
+            batch.append(_DB_QUEUE.get_nowait())
+        except queue.Empty:
+            break
+    if batch:
+        _write_batch(batch)
+    return bool(batch)
+
+def _db_writer():
+    while True:
+        _drain_db_queue(_DB_QUEUE.get())
+
+def flush_db_writes():
+    while _drain_db_queue():
+        pass
+
+def _start_db_writer():
+    threading.Thread(target=_db_writer, name="db-writer", daemon=True).start()
+
+_start_db_writer()
+atexit.register(flush_db_writes)
+
+def reinit_after_fork():
+    # gunicorn con preload_app: el worker hereda las conexiones SQLite del master
+    # (no sirven en otro proceso) y ningún thread. Abre las suyas y su escritor;
+    # los threads de inbox y Sheets ya arrancan solos (perezosos).
+    global CONN, DB_WRITE_LOCK, READ_POOL, _DB_QUEUE
+    CONN = db_connect()
+    DB_WRITE_LOCK = threading.RLock()
+    READ_POOL = SQLiteConnectionPool(READ_POOL_SIZE)
+    _DB_QUEUE = queue.Queue()
+    _start_db_writer()
+
+# ======== SQL DEL HOT PATH ========
+# Un único string por consulta: el caché de sentencias de sqlite3 va por texto, así
+# que cada conexión del pool prepara cada una solo una vez.
+SQL_GET_SESSION = "SELECT state, amount_cents FROM sessions WHERE user = ?"
+
+SQL_UPSERT_SESSION = """
+    INSERT INTO sessions(user, state, amount_cents) VALUES (?, ?, ?)
+    ON CONFLICT(user) DO UPDATE SET state=excluded.state, amount_cents=excluded.amount_cents
+"""
+
+SQL_INSERT_EXPENSE = (
+    "INSERT INTO expenses (user, amount_cents, category_id, category_name, ts_utc, ts_epoch) "
+    "VALUES (?, ?, ?, ?, ?, ?)"
+)
+
+SQL_INSERT_DEPOSIT = (
+    "INSERT INTO deposits (user, amount_cents, source, ts_utc, ts_epoch) "
+    "VALUES (?, ?, ?, ?, ?)"
+)
+
+SQL_SUM_INCOME = """
+    SELECT COALESCE(SUM(amount_cents), 0)
+    FROM deposits
+    WHERE user = ? AND ts_epoch >= ? AND ts_epoch < ?
+"""
+
+SQL_SUM_CAT = """
+    SELECT COALESCE(SUM(amount_cents), 0)
+    FROM expenses
+    WHERE user = ?
+      AND category_id = ?
+      AND ts_epoch >= ?
+      AND ts_epoch < ?
+"""
+
+SQL_SUM_ALL_GROUPED = """
+    SELECT category_id, COALESCE(SUM(amount_cents), 0)
+    FROM expenses
+    WHERE user = ?
+      AND ts_epoch >= ?
+      AND ts_epoch < ?
+    GROUP BY category_id
+"""
+
+# Upserts que el escritor puede colapsar dentro de un lote: SQL -> posición de la
+# clave en params. Varias transiciones seguidas del mismo usuario (awaiting_amount
+# -> awaiting_category -> idle) terminan en una sola fila escrita.
+COALESCE_KEY_COLUMN = {SQL_UPSERT_SESSION: 0}
 
 # ======== CATEGORÍAS / TRIGGERS ========
 CATEGORIES = {
@@ -118,30 +424,37 @@ CATEGORIES = {
 }
 TRIGGERS = {"ingresar gasto", "ingresar un gasto", "gasto", "nuevo gasto"}
 INCOME_TRIGGERS = {"ingresar ingreso", "nuevo ingreso", "ingreso", "deposito", "depósito"}
+_CATEGORY_ORDER = sorted(CATEGORIES.keys(), key=int)
 
 # ======== SESIONES (persistidas) ========
+# Caché en memoria: SQLite solo se lee al primer mensaje del usuario (o tras un
+# reinicio). Sin fila en SQLite == idle, así que un usuario idle no cuesta ninguna
+# escritura; los cambios de estado se persisten por la cola write-behind.
+SESSIONS: dict[str, dict] = {}
+SESSIONS_LOCK = threading.Lock()
+
 def get_session(user: str):
-    conn = db_connect()
-    c = conn.cursor()
-    c.execute("SELECT state, amount FROM sessions WHERE user = ?", (user,))
-    row = c.fetchone()
+    with SESSIONS_LOCK:
+        sess = SESSIONS.get(user)
+    if sess is not None:
+        return sess
+    with READ_POOL.conn() as rc:
+        row = rc.execute(SQL_GET_SESSION, (user,)).fetchone()
     if row is None:
-        c.execute("INSERT INTO sessions (user, state, amount) VALUES (?, ?, ?)", (user, "idle", None))
-        conn.commit()
-        conn.close()
-        return {"state": "idle", "amount": None}
-    conn.close()
-    return {"state": row[0], "amount": row[1]}
-
-def set_session(user: str, state: str, amount):
-    conn = db_connect()
-    c = conn.cursor()
-    c.execute("""
-        INSERT INTO sessions(user, state, amount) VALUES (?, ?, ?)
-        ON CONFLICT(user) DO UPDATE SET state=excluded.state, amount=excluded.amount
-    """, (user, state, amount))
-    conn.commit()
-    conn.close()
+        sess = {"state": "idle", "amount_cents": None}
+    else:
+        state, amount_cents = row
+        sess = {"state": state, "amount_cents": amount_cents}
+    with SESSIONS_LOCK:
+        return SESSIONS.setdefault(user, sess)
+
+def set_session(user: str, state: str, amount_cents):
+    sess = {"state": state, "amount_cents": amount_cents}
+    with SESSIONS_LOCK:
+        if SESSIONS.get(user) == sess:
+            return  # sin cambios: nada que escribir
+        SESSIONS[user] = sess
+    enqueue_write(SQL_UPSERT_SESSION, (user, state, amount_cents))
 
 def reset_session(user: str):
     set_session(user, "idle", None)
@@ -158,44 +471,90 @@ def send_whatsapp_text(to, text):
         "type": "text",
         "text": {"body": text}
     }
-    r = requests.post(GRAPH_URL_WA, headers=headers, data=json.dumps(payload), timeout=15)
+    r = HTTP.post(GRAPH_URL_WA, headers=headers, content=orjson.dumps(payload))
     if r.status_code >= 300:
         print("Error sending message:", r.status_code, r.text)
+        return False
+    return True
+
+# ======== BROADCAST (mismo texto a muchos usuarios) ========
+# Los envíos salen en paralelo por el pool HTTP, espaciados para no pasar de
+# WA_MAX_MPS mensajes por segundo (límite de throughput de Cloud API).
+WA_MAX_MPS = 50
+BROADCAST_EXECUTOR = ThreadPoolExecutor(max_workers=20)
+_WA_RATE_LOCK = threading.Lock()
+_wa_next_slot = 0.0
+
+def _wait_wa_rate_slot():
+    global _wa_next_slot
+    with _WA_RATE_LOCK:
+        slot = max(time.monotonic(), _wa_next_slot)
+        _wa_next_slot = slot + 1.0 / WA_MAX_MPS
+    delay = slot - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+
+def _broadcast_one(to, text):
+    _wait_wa_rate_slot()
+    try:
+        return send_whatsapp_text(to, text)
+    except Exception as e:
+        print("broadcast error:", to, e)
+        return False
+
+def broadcast_whatsapp_text(recipients, text):
+    # -> [(to, ok), ...] en el mismo orden que recipients
+    recipients = list(recipients)
+    results = BROADCAST_EXECUTOR.map(_broadcast_one, recipients, [text] * len(recipients))
+    return list(zip(recipients, results))
+
+# payload fijo de la lista de categorías (generado desde CATEGORIES); solo cambia
+# "to" en cada envío
+_CATEGORY_PAYLOAD_TEMPLATE = {
+    "messaging_product": "whatsapp",
+    "to": "__TO__",
+    "type": "interactive",
+    "interactive": {
+        "type": "list",
+        "body": {"text": "Elige la *categoría* del gasto:"},
+        "footer": {"text": "Toca una opción 👇"},
+        "action": {
+            "button": "Ver categorías",
+            "sections": [
+                {
+                    "title": "Categorías",
+                    "rows": [
+                        {"id": cat_id, "title": f"{cat_id}. {CATEGORIES[cat_id]}"}
+                        for cat_id in _CATEGORY_ORDER
+                    ]
+                }
+            ]
+        }
+    }
+}
+
+# El cuerpo serializado solo cambia en "to": se arma una vez y se parte en dos
+# alrededor del placeholder. Los números de WhatsApp son solo dígitos, así que no
+# hace falta escapar nada; cualquier otro "to" pasa por orjson.
+_CATEGORY_BODY_HEAD, _CATEGORY_BODY_TAIL = orjson.dumps(_CATEGORY_PAYLOAD_TEMPLATE).split(b"__TO__")
+
+# menú en texto plano si la lista interactiva falla
+CATEGORY_MENU_TEXT = (
+    "No pude enviar la lista interactiva.\n"
+    f"Escribe un número del 1 al {len(CATEGORIES)}:\n"
+    + "\n".join(f"{cat_id}. {CATEGORIES[cat_id]}" for cat_id in _CATEGORY_ORDER)
+)
 
 def send_whatsapp_category_list(to):
     headers = {
         "Authorization": f"Bearer {WHATSAPP_TOKEN}",
         "Content-Type": "application/json"
     }
-    payload = {
-        "messaging_product": "whatsapp",
-        "to": to,
-        "type": "interactive",
-        "interactive": {
-            "type": "list",
-            "body": {"text": "Elige la *categoría* del gasto:"},
-            "footer": {"text": "Toca una opción 👇"},
-            "action": {
-                "button": "Ver categorías",
-                "sections": [
-                    {
-                        "title": "Categorías",
-                        "rows": [
-                            {"id": "1", "title": "1. Renta"},
-                            {"id": "2", "title": "2. Credit card bill"},
-                            {"id": "3", "title": "3. Medical bill"},
-                            {"id": "4", "title": "4. Utility bill"},
-                            {"id": "5", "title": "5. Car payment"},
-                            {"id": "6", "title": "6. Restaurante"},
-                            {"id": "7", "title": "7. Groceries & housekeeping"},
-                            {"id": "8", "title": "8. Traveling"},
-                        ]
-                    }
-                ]
-            }
-        }
-    }
-    r = requests.post(GRAPH_URL_WA, headers=headers, data=json.dumps(payload), timeout=15)
+    if to.isdigit():
+        body = _CATEGORY_BODY_HEAD + to.encode() + _CATEGORY_BODY_TAIL
+    else:
+        body = orjson.dumps({**_CATEGORY_PAYLOAD_TEMPLATE, "to": to})
+    r = HTTP.post(GRAPH_URL_WA, headers=headers, content=body)
     if r.status_code >= 300:
         print("Error sending category list:", r.status_code, r.text)
         return False
@@ -213,6 +572,40 @@ def ask_for_income_source():
     return ("¿Cuál es el *origen* del ingreso?\n"
             "Ejemplos: Salario, Transferencia, Reembolso, Extra.")
 
+# ======== TEXTOS FIJOS ========
+HELP_TEXT = (
+    "Hola 👋\n"
+    "Para registrar un gasto, escribe: *ingresar gasto*.\n\n"
+    "Para ver totales, escribe: *resumen* (todas las entradas), *resumen mes*, *resumen 30*, "
+    f"*resumen 7*, *resumen 15*, o *resumen <cat>* (1–{len(CATEGORIES)}).\n"
+    "Comandos: *reset*, *estado*, *ingresar ingreso*, *saldo*"
+)
+
+RESET_TEXT = (
+    "🔄 Sesión reiniciada.\n"
+    "Puedes empezar de nuevo escribiendo: *ingresar gasto*.\n\n"
+    "Comandos útiles:\n"
+    "- *resumen* (todas las entradas)\n"
+    "- *resumen mes*\n"
+    "- *resumen 7* | *resumen 15* | *resumen 30*\n"
+    "- *resumen <cat>* o *resumen <cat> 7|15|30|mes*"
+)
+
+INVALID_CATEGORY_TEXT = (
+    "Respuesta inválida. Elige una opción de la lista o escribe un número "
+    f"del 1 al {len(CATEGORIES)}."
+)
+
+INCOME_CONFIRM_TEMPLATE = (
+    "✅ Ingreso guardado:\n"
+    "- Monto: ${amount}\n"
+    "- Origen: {source}\n\n"
+    "Comandos útiles:\n"
+    "- *saldo mes* | *saldo 7* | *saldo 30*\n"
+    "- *resumen* / *resumen mes* (gastos)\n"
+    "- *ingresar ingreso* / *ingresar gasto*"
+)
+
 # ======== PARSEO ENTRANTE (WhatsApp) ========
 def parse_sender_and_message(entry):
     try:
@@ -224,6 +617,7 @@ def parse_sender_and_message(entry):
                 continue
             msg = messages[0]
             from_id = msg.get("from")
+            msg_id = msg.get("id")
             msg_type = msg.get("type", "text")
 
             text = ""
@@ -242,154 +636,169 @@ def parse_sender_and_message(entry):
                     reply_id = (br.get("id") or "").strip()
                     text = (br.get("title") or "").strip()
 
-            return from_id, text, reply_id
+            return from_id, text, reply_id, msg_id
     except Exception as e:
         print("parse_sender_and_message error:", e)
-    return None, None, None
+    return None, None, None, None
+
+# ======== DEDUPE DE REENTREGAS (message.id) ========
+# Meta reenvía el mismo mensaje ante timeouts/5xx; se recuerdan los últimos ids
+SEEN_MAX = 4096
+_SEEN = OrderedDict()
+_SEEN_LOCK = threading.Lock()
+
+def mark_message_seen(msg_id) -> bool:
+    # True si es la primera vez que vemos este id
+    with _SEEN_LOCK:
+        if msg_id in _SEEN:
+            return False
+        _SEEN[msg_id] = None
+        if len(_SEEN) > SEEN_MAX:
+            _SEEN.popitem(last=False)
+        return True
 
 # ======== GASTOS (SQLite) ========
-def save_expense(user, amount, category_id, category_name):
-    conn = db_connect()
-    c = conn.cursor()
-    now = datetime.now(timezone.utc)
+def save_expense(user, amount_cents, category_id, category_name, now=None):
+    # Encola el INSERT; devuelve un Future que se resuelve tras el COMMIT
+    now = now or datetime.now(timezone.utc)
     ts_utc = now.isoformat()
     ts_epoch = int(now.timestamp())
-    c.execute(
-        "INSERT INTO expenses (user, amount, category_id, category_name, ts_utc, ts_epoch) VALUES (?, ?, ?, ?, ?, ?)",
-        (user, amount, int(category_id), category_name, ts_utc, ts_epoch)
-    )
-    conn.commit()
-    conn.close()
+    return bump_when_done(user, enqueue_write(
+        SQL_INSERT_EXPENSE,
+        (user, amount_cents, int(category_id), category_name, ts_utc, ts_epoch)
+    ))
 
 # ======== INGRESOS (SQLite) ========
-def save_deposit(user, amount, source):
-    conn = db_connect()
-    c = conn.cursor()
-    now = datetime.now(timezone.utc)
+def save_deposit(user, amount_cents, source, now=None):
+    # mismo escritor que los gastos: ráfagas de ingresos comparten COMMIT
+    now = now or datetime.now(timezone.utc)
     ts_utc = now.isoformat()
     ts_epoch = int(now.timestamp())
-    c.execute(
-        "INSERT INTO deposits (user, amount, source, ts_utc, ts_epoch) VALUES (?, ?, ?, ?, ?)",
-        (user, amount, source, ts_utc, ts_epoch)
-    )
-    conn.commit()
-    conn.close()
+    return bump_when_done(user, enqueue_write(
+        SQL_INSERT_DEPOSIT,
+        (user, amount_cents, source, ts_utc, ts_epoch)
+    ))
 
 # ======== RANGOS DE TIEMPO ========
-def month_bounds_now_ny():
+# Los límites son medianoches de Nueva York (con su horario de verano), así que se
+# calculan con TZ, pero cada (año, mes) se calcula una sola vez.
+@lru_cache(maxsize=4)
+def _month_bounds_epoch(year: int, month: int):
+    start_ny = datetime(year, month, 1, tzinfo=TZ)
+    next_month_ny = datetime(year + month // 12, month % 12 + 1, 1, tzinfo=TZ)
+    label = f"Mes actual ({year:04d}-{month:02d})"
+    return int(start_ny.timestamp()), int(next_month_ny.timestamp()), label
+
+# Atajo: mientras no se cruce el fin del mes cacheado no hace falta ni mirar el reloj NY.
+_MONTH_CURRENT = [0, None]  # [end_epoch, bounds]
+
+def month_bounds_ny():
+    if time.time() < _MONTH_CURRENT[0]:
+        return _MONTH_CURRENT[1]
     now_ny = datetime.now(TZ)
-    start_ny = now_ny.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    if start_ny.month == 12:
-        next_month_ny = start_ny.replace(year=start_ny.year + 1, month=1)
-    else:
-        next_month_ny = start_ny.replace(month=start_ny.month + 1)
-    start_utc = start_ny.astimezone(timezone.utc).isoformat()
-    end_utc = next_month_ny.astimezone(timezone.utc).isoformat()
-    label = f"Mes actual ({start_ny.strftime('%Y-%m')})"
-    return start_utc, end_utc, label
+    bounds = _month_bounds_epoch(now_ny.year, now_ny.month)
+    _MONTH_CURRENT[:] = [bounds[1], bounds]
+    return bounds
+
+# Ventanas móviles cacheadas por (n_days, minuto). El fin se redondea hacia arriba
+# al minuto siguiente para que la ventana cacheada siempre incluya lo recién guardado.
+@lru_cache(maxsize=16)
+def _last_n_days_bounds_epoch(n_days: int, bucket: int):
+    end_ny = datetime.fromtimestamp((bucket + 1) * 60, TZ)
+    start_ny = end_ny - timedelta(days=n_days)
+    return int(start_ny.timestamp()), int(end_ny.timestamp()), f"Últimos {n_days} días"
 
 def last_n_days_bounds_ny(n_days: int):
-    now_ny = datetime.now(TZ).replace(microsecond=0)
-    start_ny = now_ny - timedelta(days=n_days)
-    start_ny = start_ny.replace(second=0)
-    start_utc = start_ny.astimezone(timezone.utc).isoformat()
-    end_utc = now_ny.astimezone(timezone.utc).isoformat()
-    label = f"Últimos {n_days} días"
-    return start_utc, end_utc, label
-
-def month_bounds_epoch_ny():
-    now_ny = datetime.now(TZ)
-    start_ny = now_ny.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    if start_ny.month == 12:
-        next_month_ny = start_ny.replace(year=start_ny.year + 1, month=1)
-    else:
-        next_month_ny = start_ny.replace(month=start_ny.month + 1)
-    start_epoch = int(start_ny.timestamp())
-    end_epoch = int(next_month_ny.timestamp())
-    label = f"Mes actual ({start_ny.strftime('%Y-%m')})"
-    return start_epoch, end_epoch, label
-
-def last_n_days_bounds_epoch_ny(n_days: int):
-    now_ny = datetime.now(TZ).replace(microsecond=0)
-    start_ny = now_ny - timedelta(days=n_days)
-    start_epoch = int(start_ny.timestamp())
-    end_epoch = int(now_ny.timestamp())
-    label = f"Últimos {n_days} días"
-    return start_epoch, end_epoch, label
+    return _last_n_days_bounds_epoch(n_days, int(time.time() // 60))
 
 # ======== CONSULTAS DE INGRESOS TOTALES ========
 def get_income_total_in_range(user, start_epoch, end_epoch):
-    conn = db_connect()
-    c = conn.cursor()
-    c.execute("""
-        SELECT COALESCE(SUM(amount), 0.0)
-        FROM deposits
-        WHERE user = ? AND ts_epoch >= ? AND ts_epoch < ?
-    """, (user, int(start_epoch), int(end_epoch)))
-    total = float(c.fetchone()[0] or 0.0)
-    conn.close()
-    return total
+    with READ_POOL.conn() as rc:
+        row = rc.execute(SQL_SUM_INCOME, (user, int(start_epoch), int(end_epoch))).fetchone()
+    return int(row[0] or 0)
 
 # ======== CONSULTAS DE TOTALES ========
 def get_total_for_category_in_range(user, category_id, start_epoch, end_epoch):
-    conn = db_connect()
-    c = conn.cursor()
-    c.execute("""
-        SELECT COALESCE(SUM(amount), 0.0)
-        FROM expenses
-        WHERE user = ?
-          AND category_id = ?
-          AND ts_epoch >= ?
-          AND ts_epoch < ?
-    """, (user, int(category_id), int(start_epoch), int(end_epoch)))
-    total = c.fetchone()[0] or 0.0
-    conn.close()
-    return float(total)
+    with READ_POOL.conn() as rc:
+        row = rc.execute(SQL_SUM_CAT, (user, int(category_id), int(start_epoch), int(end_epoch))).fetchone()
+    return int(row[0] or 0)
 
 def get_totals_all_categories_in_range(user, start_epoch, end_epoch):
-    conn = db_connect()
-    c = conn.cursor()
-    totals = {}
-    for cat_id in CATEGORIES.keys():
-        c.execute("""
-            SELECT COALESCE(SUM(amount), 0.0)
-            FROM expenses
-            WHERE user = ?
-              AND category_id = ?
-              AND ts_epoch >= ?
-              AND ts_epoch < ?
-        """, (user, int(cat_id), int(start_epoch), int(end_epoch)))
-        totals[cat_id] = float(c.fetchone()[0] or 0.0)
-    conn.close()
+    with READ_POOL.conn() as rc:
+        rows = rc.execute(SQL_SUM_ALL_GROUPED, (user, int(start_epoch), int(end_epoch))).fetchall()
+    # filas como tuplas simples (sin row_factory): se desempaquetan por posición
+    totals = dict.fromkeys(CATEGORIES, 0)
+    for cat_id, total in rows:
+        key = str(cat_id)
+        if key in totals:
+            totals[key] = int(total or 0)
     return totals
 
+_TABLE_SEP = "------------------- ----------"
+_TABLE_HEADER = "Categoría            Total (USD)\n" + _TABLE_SEP
+
 def format_totals_table(totals_dict):
-    lines = ["Categoría            Total (USD)"]
-    lines.append("------------------- ----------")
-    grand_total = 0.0
-    for cat_id in sorted(CATEGORIES.keys(), key=lambda x: int(x)):
-        name = CATEGORIES[cat_id]
-        total = totals_dict.get(cat_id, 0.0)
+    # totals_dict en centavos; devuelve (tabla, total general en centavos)
+    rows = []
+    grand_total = 0
+    for cat_id in _CATEGORY_ORDER:
+        total = totals_dict.get(cat_id, 0)
         grand_total += total
-        lines.append(f"{cat_id}. {name[:18]:18} ${total:10.2f}")
-    lines.append("------------------- ----------")
-    lines.append(f"TOTAL GENERAL        ${grand_total:10.2f}")
-    return "\n".join(lines), grand_total
+        rows.append(f"{cat_id}. {CATEGORIES[cat_id][:18]:18} ${format_usd(total):>10}")
+    total_line = f"TOTAL GENERAL        ${format_usd(grand_total):>10}"
+    return "\n".join((_TABLE_HEADER, *rows, _TABLE_SEP, total_line)), grand_total
 
 def get_month_total_for_category(user, category_id):
-    start_e, end_e, _ = month_bounds_epoch_ny()
+    start_e, end_e, _ = month_bounds_ny()
     return get_total_for_category_in_range(user, category_id, start_e, end_e)
 
 # ======== UTILS ========
-def normalize_amount(text):
-    cleaned = text.replace(",", ".")
-    m = re.search(r"[-+]?\d*\.?\d+", cleaned)
+_AMOUNT_RE = re.compile(r"[-+]?\d*\.?\d+")
+_COMMA_TO_DOT = str.maketrans({",": "."})
+
+_CENT = Decimal(1)
+
+def to_cents(value):
+    # dólares (texto del usuario o float de Sheets) -> centavos exactos
+    return int((Decimal(str(value)) * 100).quantize(_CENT, rounding=ROUND_HALF_UP))
+
+def format_usd(cents):
+    # 123456 -> "1234.56", con aritmética entera (sin formatear floats)
+    sign = "-" if cents < 0 else ""
+    dollars, rest = divmod(abs(cents), 100)
+    return f"{sign}{dollars}.{rest:02d}"
+
+# tope por movimiento ($10.000.000): muy por encima de cualquier gasto real y
+# lejos del límite de INTEGER en SQLite (2^63 centavos)
+MAX_AMOUNT_CENTS = 1_000_000_000
+
+def parse_amount_cents(text):
+    m = _AMOUNT_RE.search(text.translate(_COMMA_TO_DOT))
     if not m:
         return None
     try:
-        return round(float(m.group()), 2)
-    except ValueError:
+        cents = to_cents(m.group())
+    except InvalidOperation:
+        return None
+    if abs(cents) > MAX_AMOUNT_CENTS:
         return None
+    return cents
+
+# token de ventana -> días (None = mes actual)
+_WINDOW_TOKENS = {"mes": None, "7": 7, "15": 15, "30": 30}
+
+def parse_resumen_args(parts):
+    # -> (category, days); days None = mes actual. "7" es categoría y ventana a la
+    # vez: como primer token con un segundo token detrás, manda la categoría.
+    if len(parts) >= 2 and parts[0] in CATEGORIES:
+        return parts[0], _WINDOW_TOKENS.get(parts[1])
+    if parts:
+        p1 = parts[0]
+        if p1 in _WINDOW_TOKENS:
+            return None, _WINDOW_TOKENS[p1]
+        if p1 in CATEGORIES:
+            return p1, None
+    return None, None
 
 # ======== GOOGLE SHEETS: enviar fila vía Apps Script ========
 def _url_with_key(url: str) -> str:
@@ -401,69 +810,154 @@ def _url_with_key(url: str) -> str:
         return url
     return url + ("&" if "?" in url else "?") + f"key={key}"
 
-def append_expense_to_google_sheet(user, amount, category_id, category_name):
+# URL con key= resuelta una sola vez
+SHEETS_URL = _url_with_key(GOOGLE_APPS_SCRIPT_URL) if GOOGLE_APPS_SCRIPT_URL else ""
+SHEETS_GET_URL = httpx.URL(SHEETS_URL)
+
+def sheets_get(params):
+    # Ojo: params= de httpx REEMPLAZA la query de la URL (y con ella key=);
+    # se mezcla explícitamente para conservarla.
+    return http_get(SHEETS_GET_URL.copy_merge_params(params), timeout=SHEETS_TIMEOUT)
+
+# Las filas se encolan y un thread las envía (con reintentos) fuera del mensaje.
+# Con SHEETS_BATCH_SIZE > 1 van juntas como {"rows": [...]} para que el Apps Script
+# haga un solo appendRows/setValues; un lote de una sola fila usa el formato de siempre.
+_SHEETS_PENDING = deque()  # (payload, Future)
+_SHEETS_WAKE = threading.Event()
+
+def _post_sheet_rows(payloads):
+    body = payloads[0] if len(payloads) == 1 else {"rows": payloads}
+    headers = {"Content-Type": "application/json"}
+    if GOOGLE_APPS_SCRIPT_KEY:
+        headers["X-AppsScript-Key"] = GOOGLE_APPS_SCRIPT_KEY
+    r = HTTP.post(SHEETS_URL, headers=headers, content=orjson.dumps(body), timeout=SHEETS_TIMEOUT)
+    print(f"Sheets append ({len(payloads)} rows):", r.status_code, r.text)
+    return r.status_code
+
+def _send_sheet_batch(payloads):
+    # El append no es idempotente: un timeout de lectura o un 500/502/504 suele llegar
+    # con la fila ya escrita, y reintentar la duplicaría (inflando resumen y saldo).
+    # Solo se reintenta si el POST nunca salió (fallo de conexión) o si Apps Script
+    # lo rechazó sin procesarlo (429/503). Mismo criterio que los POST a Graph: nunca
+    # se reenvía algo que pudo haberse procesado.
+    for attempt in range(SHEETS_MAX_ATTEMPTS):
+        if attempt:
+            time.sleep(SHEETS_BACKOFF * 2 ** (attempt - 1))
+        try:
+            status = _post_sheet_rows(payloads)
+        except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+            print("Google Sheets append connect error:", e)
+            continue
+        except Exception as e:
+            print("Google Sheets append exception:", e)
+            break
+        if status < 300:
+            return True
+        if status not in SHEETS_RETRY_STATUS:
+            break
+    print(f"Aviso: no se pudo escribir en Google Sheets ({len(payloads)} filas).")
+    return False
+
+def flush_sheet_rows():
+    while _SHEETS_PENDING:
+        batch = []
+        while _SHEETS_PENDING and len(batch) < SHEETS_BATCH_SIZE:
+            batch.append(_SHEETS_PENDING.popleft())
+        ok = _send_sheet_batch([payload for payload, _ in batch])
+        for _, fut in batch:
+            fut.set_result(ok)
+
+def _sheets_flusher():
+    while True:
+        _SHEETS_WAKE.wait(SHEETS_FLUSH_INTERVAL)
+        _SHEETS_WAKE.clear()
+        flush_sheet_rows()
+
+_sheets_flusher_thread = None
+_SHEETS_FLUSHER_LOCK = threading.Lock()
+
+def _ensure_sheets_flusher():
+    # arranque perezoso: un proceso hijo (fork) no hereda el thread del padre
+    global _sheets_flusher_thread
+    if _sheets_flusher_thread is not None and _sheets_flusher_thread.is_alive():
+        return
+    with _SHEETS_FLUSHER_LOCK:
+        if _sheets_flusher_thread is None or not _sheets_flusher_thread.is_alive():
+            _sheets_flusher_thread = threading.Thread(target=_sheets_flusher, name="sheets-flusher", daemon=True)
+            _sheets_flusher_thread.start()
+
+atexit.register(flush_sheet_rows)
+
+def _enqueue_sheet_row(payload):
+    # Devuelve un Future[bool] que se resuelve cuando el lote llega a Sheets
+    _ensure_sheets_flusher()
+    fut = Future()
+    _SHEETS_PENDING.append((payload, fut))
+    if len(_SHEETS_PENDING) >= SHEETS_BATCH_SIZE:
+        _SHEETS_WAKE.set()
+    return fut
+
+def _skipped_sheet_row():
+    fut = Future()
+    fut.set_result(False)
+    return fut
+
+def append_expense_to_google_sheet(user, amount_cents, category_id, category_name, now=None):
     if not GOOGLE_APPS_SCRIPT_URL:
         print("GOOGLE_APPS_SCRIPT_URL not set; skipping Sheets append.")
-        return False
-    try:
-        payload = {
-            "kind": "expense",  # IMPORTANT
-            "user": user,
-            "amount_usd": float(amount),
-            "category_id": int(category_id),
-            "category_name": category_name,
-            "timestamp_iso": datetime.now(timezone.utc).isoformat()
-        }
-        headers = {"Content-Type": "application/json"}
-        if GOOGLE_APPS_SCRIPT_KEY:
-            headers["X-AppsScript-Key"] = GOOGLE_APPS_SCRIPT_KEY
-        url = _url_with_key(GOOGLE_APPS_SCRIPT_URL)
-        r = requests.post(url, headers=headers, json=payload, timeout=15)
-        print("Sheets append:", r.status_code, r.text)
-        return r.status_code < 300
-    except Exception as e:
-        print("Google Sheets append exception:", e)
-        return False
+        return _skipped_sheet_row()
+    now = now or datetime.now(timezone.utc)
+    payload = {
+        "kind": "expense",  # IMPORTANT
+        "user": user,
+        "amount_usd": amount_cents / 100,
+        "category_id": int(category_id),
+        "category_name": category_name,
+        "timestamp_iso": now.isoformat(),
+        "timestamp_epoch": int(now.timestamp())
+    }
+    return bump_when_done(user, _enqueue_sheet_row(payload))
 
-def append_income_to_google_sheet(user, amount, source):
+def append_income_to_google_sheet(user, amount_cents, source, now=None):
     if not GOOGLE_APPS_SCRIPT_URL:
         print("GOOGLE_APPS_SCRIPT_URL not set; skipping Sheets income append.")
-        return False
+        return _skipped_sheet_row()
+    now = now or datetime.now(timezone.utc)
+    payload = {
+        "kind": "income",
+        "user": user,
+        "amount_usd": amount_cents / 100,
+        "source": source,
+        "timestamp_iso": now.isoformat(),
+        "timestamp_epoch": int(now.timestamp())
+    }
+    fut = bump_when_done(user, _enqueue_sheet_row(payload))
+    # nadie espera este Future (la confirmación sale enseguida): el fallo se registra aquí
+    fut.add_done_callback(lambda f: _log_income_sheet_result(f, user, amount_cents, source))
+    return fut
+
+def _log_income_sheet_result(fut, user, amount_cents, source):
     try:
-        payload = {
-            "kind": "income",
-            "user": user,
-            "amount_usd": float(amount),
-            "source": source,
-            "timestamp_iso": datetime.now(timezone.utc).isoformat()
-        }
-        headers = {"Content-Type": "application/json"}
-        if GOOGLE_APPS_SCRIPT_KEY:
-            headers["X-AppsScript-Key"] = GOOGLE_APPS_SCRIPT_KEY
-        url = _url_with_key(GOOGLE_APPS_SCRIPT_URL)
-        r = requests.post(url, headers=headers, json=payload, timeout=15)
-        print("Sheets income append:", r.status_code, r.text)
-        return r.status_code < 300
+        ok = fut.result()
     except Exception as e:
-        print("Sheets income append exception:", e)
-        return False
+        print("Sheets income append exception:", user, format_usd(amount_cents), source, e)
+        return
+    if not ok:
+        print(f"Aviso: ingreso no escrito en Google Sheets: {user} ${format_usd(amount_cents)} ({source})")
 
 def fetch_totals_from_sheets(user, start_e, end_e, category_id=None):
     if not GOOGLE_APPS_SCRIPT_URL:
         return None
     try:
-        base = _url_with_key(GOOGLE_APPS_SCRIPT_URL)
         params = {
             "action": "summary",
             "user": user,
-            "start_e": str(int(start_e)),
-            "end_e": str(int(end_e))
+            "start_e": int(start_e),
+            "end_e": int(end_e)
         }
         if category_id:
-            params["category_id"] = str(int(category_id))
-        qs = "&".join([f"{k}={requests.utils.quote(v)}" for k, v in params.items()])
-        url = base + ("&" if "?" in base else "?") + qs
-        r = requests.get(url, timeout=15)
+            params["category_id"] = int(category_id)
+        r = sheets_get(params)
         if r.status_code >= 300:
             print("Sheets summary error:", r.status_code, r.text)
             return None
@@ -480,10 +974,8 @@ def fetch_balance_from_sheets(user, start_e, end_e):
     if not GOOGLE_APPS_SCRIPT_URL:
         return None
     try:
-        base = _url_with_key(GOOGLE_APPS_SCRIPT_URL)
-        qs = f"action=balance&user={requests.utils.quote(user)}&start_e={int(start_e)}&end_e={int(end_e)}"
-        url = base + ("&" if "?" in base else "?") + qs
-        r = requests.get(url, timeout=15)
+        params = {"action": "balance", "user": user, "start_e": int(start_e), "end_e": int(end_e)}
+        r = sheets_get(params)
         if r.status_code >= 300:
             print("Sheets balance error:", r.status_code, r.text)
             return None
@@ -501,26 +993,327 @@ def handle_resumen():
     try:
         if not GOOGLE_APPS_SCRIPT_URL:
             return "⚠️ Falta GOOGLE_APPS_SCRIPT_URL en .env"
-        base = _url_with_key(GOOGLE_APPS_SCRIPT_URL)
-        url = base + ("&" if "?" in base else "?") + "action=summary&start_e=0&end_e=9999999999"
-        res = requests.get(url, timeout=15)
+        params = {"action": "summary", "start_e": 0, "end_e": 9999999999}
+        res = sheets_get(params)
         res.raise_for_status()
         data = res.json()
         if not data.get("ok"):
             return f"⚠️ Error leyendo resumen: {data}"
         totals = data.get("totals", {}) or {}
-        totals_norm = {str(k): float(v or 0.0) for k, v in totals.items()}
+        totals_norm = {str(k): to_cents(v or 0) for k, v in totals.items()}
         lines = ["🧮 *Resumen general de todos los gastos:*"]
-        grand_total = 0.0
+        grand_total = 0
         for cat_id, amt in sorted(totals_norm.items(), key=lambda x: -x[1]):
             name = CATEGORIES.get(str(cat_id), f"Cat {cat_id}")
             grand_total += amt
-            lines.append(f"• {name}: ${amt:.2f}")
-        lines.append(f"\nTotal general: ${grand_total:.2f}")
+            lines.append(f"• {name}: ${format_usd(amt)}")
+        lines.append(f"\nTotal general: ${format_usd(grand_total)}")
         return "\n".join(lines)
     except Exception as e:
         return f"⚠️ No pude generar el resumen: {e}"
 
+# ======== CONFIRMACIÓN DE GASTO (en EXECUTOR) ========
+def finish_expense(user, amount_cents, category_id, category_name, saved, now=None):
+    # Append a Sheets -> total del mes -> confirmación; el total se lee después del
+    # append para que incluya el gasto recién guardado. `saved` es el Future del
+    # INSERT: no se confirma nada al usuario hasta que el gasto está en SQLite.
+    try:
+        saved.result()
+    except Exception as e:
+        print("finish_expense: save_expense failed:", e)
+        send_whatsapp_text(user, "⚠️ No pude guardar el gasto. Intenta de nuevo.")
+        return
+    try:
+        fut_sheet = append_expense_to_google_sheet(
+            user=user,
+            amount_cents=amount_cents,
+            category_id=category_id,
+            category_name=category_name,
+            now=now
+        )
+        try:
+            ok_sheet = fut_sheet.result(timeout=SHEETS_WAIT_TIMEOUT)
+        except FutureTimeout:
+            ok_sheet = False
+        if not ok_sheet:
+            print("Aviso: no se pudo escribir en Google Sheets (Apps Script).")
+
+        month_start_e, month_end_e, _ = month_bounds_ny()
+        totals_m = fetch_totals_from_sheets(user, month_start_e, month_end_e, category_id=int(category_id))
+        if totals_m:
+            month_total = to_cents(totals_m.get(str(int(category_id)), 0))
+        else:
+            month_total = get_total_for_category_in_range(user, category_id, month_start_e, month_end_e)
+
+        msg = (
+            "✅ Gasto guardado:\n"
+            f"- Monto: ${format_usd(amount_cents)}\n"
+            f"- Categoría: {category_id}. {category_name}\n\n"
+            f"📊 Total del mes en *{category_name}*: ${format_usd(month_total)}\n\n"
+            "Comandos útiles:\n"
+            "- *resumen* (todas las entradas)\n"
+            "- *resumen mes*\n"
+            "- *resumen 7* | *resumen 15* | *resumen 30*\n"
+            "- *resumen <cat>* o *resumen <cat> 7|15|30|mes*\n"
+            "Escribe *ingresar gasto* para capturar otro."
+        )
+        send_whatsapp_text(user, msg)
+    except Exception as e:
+        print("finish_expense error:", e)
+
+# ======== CONFIRMACIÓN DE INGRESO (en EXECUTOR) ========
+def finish_income(user, amount_cents, source, saved, now=None):
+    # Igual que finish_expense: nada va a Sheets ni se confirma hasta el COMMIT,
+    # así Sheets nunca tiene una fila que SQLite no tiene.
+    try:
+        saved.result()
+    except Exception as e:
+        print("finish_income: save_deposit failed:", e)
+        send_whatsapp_text(user, "⚠️ No pude guardar el ingreso. Intenta de nuevo.")
+        return
+    try:
+        # encolado: el flusher lo envía (con reintentos); nadie espera su resultado
+        append_income_to_google_sheet(user, amount_cents, source, now=now)
+        send_whatsapp_text(user, INCOME_CONFIRM_TEMPLATE.format(amount=format_usd(amount_cents), source=source))
+    except Exception as e:
+        print("finish_income error:", e)
+
+# ======== TOTALES PARA RESUMEN / SALDO (Sheets -> SQLite, con caché) ========
+# Todo en centavos: lo que llega de Sheets (dólares) se convierte con to_cents.
+# Repetir *resumen* o *saldo* sin registrar nada nuevo no vuelve a ir a Sheets ni a
+# SQLite. La clave lleva la versión del usuario, que sube cuando un gasto/ingreso
+# queda escrito (COMMIT en SQLite y lote enviado a Sheets): un resumen pedido entre
+# el encolado y la escritura no deja cacheado un total viejo. El TTL cubre filas
+# que lleguen a Sheets por otro lado.
+SUMMARY_TTL = 60
+SUMMARY_CACHE_MAX = 2048
+_SUMMARY_CACHE = {}  # (user, versión, tipo, ...) -> (vence_monotonic, valor)
+_USER_VERSION = {}
+_SUMMARY_LOCK = threading.Lock()
+
+def bump_user_version(user):
+    with _SUMMARY_LOCK:
+        _USER_VERSION[user] = _USER_VERSION.get(user, 0) + 1
+
+def bump_when_done(user, fut):
+    fut.add_done_callback(lambda _: bump_user_version(user))
+    return fut
+
+def cached_summary(user, key, compute):
+    now = time.monotonic()
+    with _SUMMARY_LOCK:
+        full_key = (user, _USER_VERSION.get(user, 0)) + key
+        hit = _SUMMARY_CACHE.get(full_key)
+    if hit is not None and hit[0] > now:
+        return hit[1]
+    value = compute()
+    with _SUMMARY_LOCK:
+        if len(_SUMMARY_CACHE) >= SUMMARY_CACHE_MAX:
+            _SUMMARY_CACHE.clear()
+        _SUMMARY_CACHE[full_key] = (now + SUMMARY_TTL, value)
+    return value
+
+def category_total(user, category, start_e, end_e):
+    def compute():
+        totals = fetch_totals_from_sheets(user, start_e, end_e, category_id=int(category))
+        if totals:
+            return to_cents(totals.get(str(int(category)), 0))
+        return get_total_for_category_in_range(user, category, start_e, end_e)
+    return cached_summary(user, ("cat", category, start_e, end_e), compute)
+
+def all_category_totals(user, start_e, end_e):
+    def compute():
+        totals = fetch_totals_from_sheets(user, start_e, end_e)
+        if totals:
+            return {str(k): to_cents(v or 0) for k, v in totals.items()}
+        return get_totals_all_categories_in_range(user, start_e, end_e)
+    return cached_summary(user, ("all", start_e, end_e), compute)
+
+def balance_totals(user, start_e, end_e):
+    # (ingresos, gastos) en centavos
+    def compute():
+        data_bal = fetch_balance_from_sheets(user, start_e, end_e)
+        if data_bal:
+            return to_cents(data_bal.get("incomes_total", 0)), to_cents(data_bal.get("expenses_total", 0))
+        exp_by_cat = get_totals_all_categories_in_range(user, start_e, end_e)
+        return get_income_total_in_range(user, start_e, end_e), sum(exp_by_cat.values())
+    return cached_summary(user, ("saldo", start_e, end_e), compute)
+
+# ======== COMANDOS (texto exacto / prefijo) ========
+RESET_WORDS = {"reset", "reiniciar", "cancel", "cancelar"}
+
+def cmd_reset(user, sess, args):
+    reset_session(user)
+    send_whatsapp_text(user, RESET_TEXT)
+
+def cmd_estado(user, sess, args):
+    send_whatsapp_text(
+        user,
+        f"🧭 Estado actual: {sess['state']}\n"
+        f"Monto en memoria: {format_usd(sess['amount_cents']) if sess['amount_cents'] is not None else '—'}"
+    )
+
+def cmd_resumen(user, sess, args):
+    if not args:
+        send_whatsapp_text(user, handle_resumen())
+        return
+
+    category, days = parse_resumen_args(args)
+    if days:
+        start_e, end_e, label = last_n_days_bounds_ny(days)
+    else:
+        start_e, end_e, label = month_bounds_ny()
+
+    if category:
+        total = category_total(user, category, start_e, end_e)
+        cat_name = CATEGORIES[category]
+        msg = (
+            f"📊 Resumen de *{cat_name}* ({label}):\n"
+            f"Total: ${format_usd(total)}\n\n"
+            "Puedes usar:\n"
+            "- resumen 7 | 15 | 30\n"
+            "- resumen mes\n"
+            "- resumen <cat>\n"
+            "- resumen <cat> 7 | 15 | 30 | mes"
+        )
+        send_whatsapp_text(user, msg)
+    else:
+        table, grand_total = format_totals_table(all_category_totals(user, start_e, end_e))
+        msg = (
+            f"📊 Resumen ({label}):\n\n"
+            f"{table}\n\n"
+            f"Total general: ${format_usd(grand_total)}\n\n"
+            "Usa:\n"
+            "- resumen 7 | 15 | 30\n"
+            "- resumen mes\n"
+            "- resumen <cat>\n"
+            "- resumen <cat> 7 | 15 | 30 | mes"
+        )
+        send_whatsapp_text(user, msg)
+
+def cmd_saldo(user, sess, args):
+    # ingresos - gastos; solo mira el primer token (mes | 7 | 15 | 30)
+    days = _WINDOW_TOKENS.get(args[0]) if args else None
+    if days:
+        start_e, end_e, label = last_n_days_bounds_ny(days)
+    else:
+        start_e, end_e, label = month_bounds_ny()
+
+    inc_total, exp_total = balance_totals(user, start_e, end_e)
+    balance = inc_total - exp_total
+    msg = (
+        f"📘 *Saldo ({label})*\n"
+        f"Ingresos: ${format_usd(inc_total)}\n"
+        f"Gastos:   ${format_usd(exp_total)}\n"
+        f"──────────────\n"
+        f"*Balance:* ${format_usd(balance)}"
+    )
+    send_whatsapp_text(user, msg)
+
+def cmd_start_income(user, sess, args):
+    set_session(user, "awaiting_income_amount", None)
+    send_whatsapp_text(user, ask_for_income_amount())
+
+def cmd_start_expense(user, sess, args):
+    set_session(user, "awaiting_amount", None)
+    send_whatsapp_text(user, ask_for_amount())
+
+# ======== FLUJOS (según el estado de la sesión) ========
+def on_expense_amount(user, sess, text, reply_id, now_utc):
+    amount_cents = parse_amount_cents(text or "")
+    if amount_cents is None or amount_cents <= 0:
+        send_whatsapp_text(user, "El valor no parece válido. Intenta de nuevo (ej: 12.75).")
+        return
+    set_session(user, "awaiting_category", amount_cents)
+    send_whatsapp_text(user, f"Perfecto. Monto registrado: ${format_usd(amount_cents)}.")
+    ok = send_whatsapp_category_list(user)
+    if not ok:
+        send_whatsapp_text(user, CATEGORY_MENU_TEXT)
+
+def on_income_amount(user, sess, text, reply_id, now_utc):
+    amount_cents = parse_amount_cents(text or "")
+    if amount_cents is None or amount_cents <= 0:
+        send_whatsapp_text(user, "El monto no parece válido. Intenta de nuevo (ej: 1200.00).")
+        return
+    set_session(user, "awaiting_income_source", amount_cents)
+    send_whatsapp_text(user, f"Perfecto. Ingreso: ${format_usd(amount_cents)}.\n" + ask_for_income_source())
+
+def on_expense_category(user, sess, text, reply_id, now_utc):
+    lowered = (text or "").strip().lower()
+    chosen = None
+    if reply_id and reply_id in CATEGORIES:
+        chosen = reply_id
+    elif lowered in CATEGORIES:
+        chosen = lowered
+
+    if not chosen:
+        # la lista interactiva sigue en el chat: se reenvía en el 1.º, 4.º, 7.º... intento
+        # (contador solo en memoria; set_session arma un dict nuevo y lo reinicia)
+        invalid_count = sess.get("invalid_count", 0) + 1
+        sess["invalid_count"] = invalid_count
+        send_whatsapp_text(user, INVALID_CATEGORY_TEXT)
+        if invalid_count % 3 == 1:
+            send_whatsapp_category_list(user)
+        return
+
+    amount_cents = sess["amount_cents"] or 0
+    category_id = chosen
+    category_name = CATEGORIES[category_id]
+
+    saved = save_expense(user, amount_cents, category_id, category_name, now=now_utc)
+    reset_session(user)
+    EXECUTOR.submit(finish_expense, user, amount_cents, category_id, category_name, saved, now_utc)
+
+def on_income_source(user, sess, text, reply_id, now_utc):
+    # NFKC: letras de ancho completo / ligaduras se guardan igual que las normales
+    source = unicodedata.normalize("NFKC", text or "").strip()
+    if len(source) < 2:
+        send_whatsapp_text(user, "Por favor escribe un origen válido (ej: Salario, Transferencia).")
+        return
+
+    amount_cents = sess["amount_cents"] or 0
+
+    saved = save_deposit(user, amount_cents, source, now=now_utc)
+    reset_session(user)
+    EXECUTOR.submit(finish_income, user, amount_cents, source, saved, now_utc)
+
+def send_help(user):
+    send_whatsapp_text(user, HELP_TEXT)
+
+# ======== DISPATCH ========
+# Los comandos mandan sobre el estado de la sesión (p.ej. *reset* en medio de un flujo).
+_EXACT_COMMANDS = {
+    **{word: cmd_reset for word in RESET_WORDS},
+    "estado": cmd_estado,
+    **{word: cmd_start_income for word in INCOME_TRIGGERS},
+    **{word: cmd_start_expense for word in TRIGGERS},
+}
+_PREFIX_COMMANDS = {"resumen": cmd_resumen, "saldo": cmd_saldo}
+# un solo match para todos los prefijos (como startswith: "resumen7" también cuenta)
+_PREFIX_COMMAND_RE = re.compile("|".join(map(re.escape, _PREFIX_COMMANDS)))
+_STATE_HANDLERS = {
+    "awaiting_amount": on_expense_amount,
+    "awaiting_income_amount": on_income_amount,
+    "awaiting_category": on_expense_category,
+    "awaiting_income_source": on_income_source,
+}
+
+def dispatch_message(user, sess, text, reply_id, now_utc):
+    lowered = (text or "").strip().lower()
+    command = _EXACT_COMMANDS.get(lowered)
+    if command:
+        command(user, sess, [])
+        return
+    m = _PREFIX_COMMAND_RE.match(lowered)
+    if m:
+        _PREFIX_COMMANDS[m.group()](user, sess, lowered.split()[1:])
+        return
+    on_state = _STATE_HANDLERS.get(sess["state"])
+    if on_state:
+        on_state(user, sess, text, reply_id, now_utc)
+        return
+    send_help(user)
+
 # ======== WEBHOOK VERIFY (GET) ========
 @app.route("/webhook", methods=["GET"])
 def verify():
@@ -531,324 +1324,92 @@ def verify():
         return challenge, 200
     return "Verification failed", 403
 
-# ======== WEBHOOK MENSAJES (POST) ========
-@app.route("/webhook", methods=["POST"])
-def webhook():
-    data = request.get_json(silent=True, force=True) or {}
-    entries = data.get("entry", [])
-    for entry in entries:
+# ======== INBOX (ack inmediato + orden por usuario) ========
+# Meta reintenta si el 200 tarda, así que el view solo encola el payload. Un
+# dispatcher descarta reentregas y reparte cada mensaje a un carril fijo según el
+# usuario: los mensajes de un mismo usuario se procesan en orden (el "1" no se
+# adelanta al "ingresar gasto" que lo precede) y usuarios distintos en paralelo.
+# Si un carril se llena el dispatcher espera, el inbox se llena y el view responde
+# 503 para que Meta reintente más tarde.
+INBOX_LANES = 8
+LANE_MAX_PENDING = 64
+_INBOX = queue.Queue(maxsize=WEBHOOK_MAX_PENDING)
+_LANES = [queue.Queue(maxsize=LANE_MAX_PENDING) for _ in range(INBOX_LANES)]
+_inbox_threads = {}
+_INBOX_LOCK = threading.Lock()
+
+def _inbox_dispatcher():
+    while True:
+        data = _INBOX.get()
         try:
-            user, text, reply_id = parse_sender_and_message(entry)
-            if not user:
-                continue
-
-            sess = get_session(user)
-            state = sess["state"]
-            lowered = (text or "").strip().lower()
-
-            # ---------- RESET ----------
-            if lowered in {"reset", "reiniciar", "cancel", "cancelar"}:
-                reset_session(user)
-                send_whatsapp_text(
-                    user,
-                    "🔄 Sesión reiniciada.\n"
-                    "Puedes empezar de nuevo escribiendo: *ingresar gasto*.\n\n"
-                    "Comandos útiles:\n"
-                    "- *resumen* (todas las entradas)\n"
-                    "- *resumen mes*\n"
-                    "- *resumen 7* | *resumen 15* | *resumen 30*\n"
-                    "- *resumen <cat>* o *resumen <cat> 7|15|30|mes*"
-                )
-                continue
-
-            # ---------- ESTADO ----------
-            if lowered == "estado":
-                sess_dbg = get_session(user)
-                send_whatsapp_text(
-                    user,
-                    f"🧭 Estado actual: {sess_dbg['state']}\n"
-                    f"Monto en memoria: {sess_dbg['amount'] if sess_dbg['amount'] is not None else '—'}"
-                )
-                continue
-
-            # ---------- RESUMEN ----------
-            if lowered.startswith("resumen"):
-                parts = lowered.split()
-                if len(parts) == 1:
-                    msg = handle_resumen()
-                    send_whatsapp_text(user, msg)
-                    continue
-
-                category = None
-                days = None
-                use_month = False
-                parts = parts[1:]
-
-                if len(parts) == 0:
-                    use_month = True
-                elif len(parts) == 1:
-                    p1 = parts[0]
-                    if p1 in {"mes"}:
-                        use_month = True
-                    elif p1 in {"7", "15", "30"}:
-                        days = int(p1)
-                    elif p1 in CATEGORIES:
-                        category = p1
-                        use_month = True
-                    else:
-                        use_month = True
-                elif len(parts) >= 2:
-                    p1, p2 = parts[0], parts[1]
-                    if p1 in CATEGORIES:
-                        category = p1
-                        if p2 in {"mes"}:
-                            use_month = True
-                        elif p2 in {"7", "15", "30"}:
-                            days = int(p2)
-                        else:
-                            use_month = True
-                    elif p1 in {"7", "15", "30"}:
-                        days = int(p1)
-                    elif p1 in {"mes"}:
-                        use_month = True
-                    else:
-                        use_month = True
-
-                if use_month:
-                    start_e, end_e, label = month_bounds_epoch_ny()
-                elif days:
-                    start_e, end_e, label = last_n_days_bounds_epoch_ny(days)
-                else:
-                    start_e, end_e, label = month_bounds_epoch_ny()
-
-                if category:
-                    totals = fetch_totals_from_sheets(user, start_e, end_e, category_id=int(category))
-                    if totals:
-                        key = str(int(category))
-                        total = float(totals.get(key, 0.0))
-                    else:
-                        total = get_total_for_category_in_range(user, category, start_e, end_e)
-                    cat_name = CATEGORIES[category]
-                    msg = (
-                        f"📊 Resumen de *{cat_name}* ({label}):\n"
-                        f"Total: ${total:.2f}\n\n"
-                        "Puedes usar:\n"
-                        "- resumen 7 | 15 | 30\n"
-                        "- resumen mes\n"
-                        "- resumen <cat>\n"
-                        "- resumen <cat> 7 | 15 | 30 | mes"
-                    )
-                    send_whatsapp_text(user, msg)
-                else:
-                    totals = fetch_totals_from_sheets(user, start_e, end_e)
-                    if totals:
-                        merged = {str(k): float(v or 0.0) for k, v in totals.items()}
-                        table, grand_total = format_totals_table(merged)
-                    else:
-                        sqlite_totals = get_totals_all_categories_in_range(user, start_e, end_e)
-                        table, grand_total = format_totals_table(sqlite_totals)
-                    msg = (
-                        f"📊 Resumen ({label}):\n\n"
-                        f"{table}\n\n"
-                        f"Total general: ${grand_total:.2f}\n\n"
-                        "Usa:\n"
-                        "- resumen 7 | 15 | 30\n"
-                        "- resumen mes\n"
-                        "- resumen <cat>\n"
-                        "- resumen <cat> 7 | 15 | 30 | mes"
-                    )
-                    send_whatsapp_text(user, msg)
-                continue
-
-            # ---------- SALDO (ingresos - gastos) ----------
-            if lowered.startswith("saldo"):
-                parts = lowered.split()[1:]
-                days = None
-                use_month = True if not parts else False
-                if parts:
-                    p1 = parts[0]
-                    if p1 in {"mes"}:
-                        use_month = True
-                    elif p1 in {"7", "15", "30"}:
-                        days = int(p1)
-                    else:
-                        use_month = True
-
-                if use_month:
-                    start_e, end_e, label = month_bounds_epoch_ny()
-                elif days:
-                    start_e, end_e, label = last_n_days_bounds_epoch_ny(days)
-                else:
-                    start_e, end_e, label = month_bounds_epoch_ny()
-
-                data_bal = fetch_balance_from_sheets(user, start_e, end_e)
-                if data_bal:
-                    exp_total = float(data_bal.get("expenses_total", 0.0))
-                    inc_total = float(data_bal.get("incomes_total", 0.0))
-                else:
-                    exp_by_cat = get_totals_all_categories_in_range(user, start_e, end_e)
-                    exp_total = sum(exp_by_cat.values())
-                    inc_total = get_income_total_in_range(user, start_e, end_e)
-
-                balance = inc_total - exp_total
-                msg = (
-                    f"📘 *Saldo ({label})*\n"
-                    f"Ingresos: ${inc_total:.2f}\n"
-                    f"Gastos:   ${exp_total:.2f}\n"
-                    f"──────────────\n"
-                    f"*Balance:* ${balance:.2f}"
-                )
-                send_whatsapp_text(user, msg)
-                continue
-
-            # ---------- INICIAR FLUJO DE INGRESO ----------
-            if lowered in INCOME_TRIGGERS:
-                set_session(user, "awaiting_income_amount", None)
-                send_whatsapp_text(user, ask_for_income_amount())
-                continue
-
-            # ---------- INICIAR FLUJO DE GASTO ----------
-            if lowered in TRIGGERS:
-                set_session(user, "awaiting_amount", None)
-                send_whatsapp_text(user, ask_for_amount())
-                continue
-
-            # ---------- ESPERANDO MONTO DE GASTO ----------
-            if state == "awaiting_amount":
-                amount = normalize_amount(text or "")
-                if amount is None or amount <= 0:
-                    send_whatsapp_text(user, "El valor no parece válido. Intenta de nuevo (ej: 12.75).")
-                    continue
-                set_session(user, "awaiting_category", amount)
-                send_whatsapp_text(user, f"Perfecto. Monto registrado: ${amount:.2f}.")
-                ok = send_whatsapp_category_list(user)
-                if not ok:
-                    send_whatsapp_text(
-                        user,
-                        "No pude enviar la lista interactiva.\n"
-                        "Escribe un número del 1 al 8:\n"
-                        "1. Renta\n2. Credit card bill\n3. Medical bill\n4. Utility bill\n"
-                        "5. Car payment\n6. Restaurante\n7. Groceries & housekeeping\n8. Traveling"
-                    )
-                continue
-
-            # ---------- ESPERANDO MONTO DE INGRESO ----------
-            if state == "awaiting_income_amount":
-                amount = normalize_amount(text or "")
-                if amount is None or amount <= 0:
-                    send_whatsapp_text(user, "El monto no parece válido. Intenta de nuevo (ej: 1200.00).")
-                    continue
-                set_session(user, "awaiting_income_source", amount)
-                send_whatsapp_text(user, f"Perfecto. Ingreso: ${amount:.2f}.\n" + ask_for_income_source())
-                continue
-
-            # ---------- ESPERANDO CATEGORÍA (GASTO) ----------
-            if state == "awaiting_category":
-                chosen = None
-                if reply_id and reply_id in CATEGORIES:
-                    chosen = reply_id
-                elif lowered in CATEGORIES:
-                    chosen = lowered
-
-                if chosen:
-                    sess2 = get_session(user)
-                    amount = float(sess2["amount"] or 0.0)
-                    category_id = chosen
-                    category_name = CATEGORIES[category_id]
-
-                    save_expense(user, amount, category_id, category_name)
-                    ok_sheet = append_expense_to_google_sheet(
-                        user=user,
-                        amount=amount,
-                        category_id=category_id,
-                        category_name=category_name
-                    )
-                    if not ok_sheet:
-                        print("Aviso: no se pudo escribir en Google Sheets (Apps Script).")
-
-                    month_start_e, month_end_e, _ = month_bounds_epoch_ny()
-                    totals_m = fetch_totals_from_sheets(user, month_start_e, month_end_e, category_id=int(category_id))
-                    if totals_m:
-                        month_total = float(totals_m.get(str(int(category_id)), 0.0))
-                    else:
-                        month_total = get_total_for_category_in_range(user, category_id, month_start_e, month_end_e)
-
-                    msg = (
-                        "✅ Gasto guardado:\n"
-                        f"- Monto: ${amount:.2f}\n"
-                        f"- Categoría: {category_id}. {category_name}\n\n"
-                        f"📊 Total del mes en *{category_name}*: ${month_total:.2f}\n\n"
-                        "Comandos útiles:\n"
-                        "- *resumen* (todas las entradas)\n"
-                        "- *resumen mes*\n"
-                        "- *resumen 7* | *resumen 15* | *resumen 30*\n"
-                        "- *resumen <cat>* o *resumen <cat> 7|15|30|mes*\n"
-                        "Escribe *ingresar gasto* para capturar otro."
-                    )
-                    send_whatsapp_text(user, msg)
-                    reset_session(user)
-                    continue
-                else:
-                    send_whatsapp_text(
-                        user,
-                        "Respuesta inválida. Elige una opción de la lista o escribe un número del 1 al 8."
-                    )
-                    send_whatsapp_category_list(user)
+            for entry in data.get("entry", []):
+                user, text, reply_id, msg_id = parse_sender_and_message(entry)
+                if not user:
                     continue
-
-            # ---------- ESPERANDO ORIGEN DE INGRESO ----------
-            if state == "awaiting_income_source":
-                source = (text or "").strip()
-                if len(source) < 2:
-                    send_whatsapp_text(user, "Por favor escribe un origen válido (ej: Salario, Transferencia).")
+                if msg_id and not mark_message_seen(msg_id):
+                    print("Mensaje duplicado ignorado:", msg_id)
                     continue
+                _LANES[hash(user) % INBOX_LANES].put((user, text, reply_id))
+        except Exception as e:
+            print("inbox dispatch error:", e)
+
+def _lane_worker(lane):
+    while True:
+        user, text, reply_id = lane.get()
+        process_message(user, text, reply_id)
+
+def _start_inbox_thread(name, target, *args):
+    t = _inbox_threads.get(name)
+    if t is None or not t.is_alive():
+        t = threading.Thread(target=target, args=args, name=name, daemon=True)
+        t.start()
+        _inbox_threads[name] = t
+
+def _ensure_inbox_workers():
+    # arranque perezoso, igual que el flusher de Sheets (un fork no hereda threads)
+    with _INBOX_LOCK:
+        _start_inbox_thread("inbox-dispatcher", _inbox_dispatcher)
+        for i, lane in enumerate(_LANES):
+            _start_inbox_thread(f"inbox-lane-{i}", _lane_worker, lane)
 
-                sess2 = get_session(user)
-                amount = float(sess2["amount"] or 0.0)
-
-                save_deposit(user, amount, source)
-                ok_sheet = append_income_to_google_sheet(user, amount, source)
-                if not ok_sheet:
-                    print("Aviso: no se pudo escribir ingreso en Google Sheets.")
-
-                send_whatsapp_text(
-                    user,
-                    "✅ Ingreso guardado:\n"
-                    f"- Monto: ${amount:.2f}\n"
-                    f"- Origen: {source}\n\n"
-                    "Comandos útiles:\n"
-                    "- *saldo mes* | *saldo 7* | *saldo 30*\n"
-                    "- *resumen* / *resumen mes* (gastos)\n"
-                    "- *ingresar ingreso* / *ingresar gasto*"
-                )
-                reset_session(user)
-                continue
+# ======== WEBHOOK MENSAJES (POST) ========
+@app.route("/webhook", methods=["POST"])
+def webhook():
+    # cache=False: el cuerpo se lee una sola vez y Werkzeug no guarda una copia
+    raw = request.get_data(cache=False)
+    try:
+        data = (orjson.loads(raw) if raw else None) or {}
+    except orjson.JSONDecodeError:
+        data = {}
+    _ensure_inbox_workers()
+    try:
+        _INBOX.put_nowait(data)
+    except queue.Full:
+        print("webhook saturado: payload rechazado con 503")
+        return jsonify(status="busy"), 503
+    return jsonify(status="ok"), 200
 
-            # ---------- IDLE / AYUDA ----------
-            send_whatsapp_text(
-                user,
-                "Hola 👋\n"
-                "Para registrar un gasto, escribe: *ingresar gasto*.\n\n"
-                "Para ver totales, escribe: *resumen* (todas las entradas), *resumen mes*, *resumen 30*, "
-                "*resumen 7*, *resumen 15*, o *resumen <cat>* (1–8).\n"
-                "Comandos: *reset*, *estado*, *ingresar ingreso*, *saldo*"
-            )
+def process_message(user, text, reply_id):
+    try:
+        # un solo reloj por mensaje: SQLite y Sheets guardan el mismo timestamp
+        now_utc = datetime.now(timezone.utc)
 
-        except Exception as e:
-            print("webhook error:", e)
-            try:
-                # Best-effort notify user
-                user = user if 'user' in locals() else None
-                if user:
-                    send_whatsapp_text(user, "⚠️ Ocurrió un error procesando tu mensaje. Intenta de nuevo.")
-            except Exception:
-                pass
+        sess = get_session(user)
+        dispatch_message(user, sess, text, reply_id, now_utc)
 
-    return jsonify(status="ok"), 200
+    except Exception as e:
+        print("webhook error:", e)
+        try:
+            # Best-effort notify user
+            send_whatsapp_text(user, "⚠️ Ocurrió un error procesando tu mensaje. Intenta de nuevo.")
+        except Exception:
+            pass
 
 # ======== RUN ========
+# Desarrollo: python app.py. Producción: gunicorn -c gunicorn.conf.py wsgi:app
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    from gevent.pywsgi import WSGIServer
+    WSGIServer(("0.0.0.0", 5000), app).serve_forever()
 
 
 
@@ -0,0 +1,21 @@
+# gunicorn.conf.py — producción: gunicorn -c gunicorn.conf.py wsgi:app
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:5000")
+
+# Un solo worker a propósito: sesiones en memoria, dedupe de message.id y el orden
+# por usuario del inbox viven en el proceso. La concurrencia la da gevent.
+# Fijo, sin leer WEB_CONCURRENCY: algunos PaaS (Heroku) lo ponen solos y con 2+
+# workers cada uno se queda con sesiones viejas y rompe los flujos.
+workers = 1
+worker_class = "gevent"  # app.py ya hace monkey.patch_all() al importarse
+worker_connections = int(os.getenv("WORKER_CONNECTIONS", "200"))
+timeout = 30
+
+# El master importa app una vez (revisa el esquema SQLite una sola vez);
+# cada worker abre sus propias conexiones en post_fork.
+preload_app = True
+
+def post_fork(server, worker):
+    from app import reinit_after_fork
+    reinit_after_fork()
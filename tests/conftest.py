@@ -0,0 +1,67 @@
+# app abre expenses.db en el directorio actual al importarse (y migra el esquema),
+# así que se importa una sola vez por sesión, sobre una base con el esquema original
+# (montos REAL) y algunas filas que test_money usa para revisar la migración.
+import importlib
+import os
+import sqlite3
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+
+BASELINE_SCHEMA = """
+CREATE TABLE expenses (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user TEXT NOT NULL,
+    amount REAL NOT NULL,
+    category_id INTEGER NOT NULL,
+    category_name TEXT NOT NULL,
+    ts_utc TEXT NOT NULL,
+    ts_epoch INTEGER
+);
+CREATE TABLE deposits (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user TEXT NOT NULL,
+    amount REAL NOT NULL,
+    source TEXT NOT NULL,
+    ts_utc TEXT NOT NULL,
+    ts_epoch INTEGER
+);
+CREATE TABLE sessions (
+    user TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    amount REAL
+);
+"""
+
+@pytest.fixture(scope="session")
+def app(tmp_path_factory):
+    assert "app" not in sys.modules, "app ya importado: la migración no correría sobre la base de prueba"
+    workdir = tmp_path_factory.mktemp("db")
+    conn = sqlite3.connect(workdir / "expenses.db")
+    conn.executescript(BASELINE_SCHEMA)
+    conn.executemany(
+        "INSERT INTO expenses (user, amount, category_id, category_name, ts_utc, ts_epoch) VALUES (?, ?, ?, ?, ?, ?)",
+        [
+            ("15550001", 0.1, 1, "Renta", "2024-03-01T12:00:00+00:00", 1709294400),
+            ("15550001", 0.2, 1, "Renta", "2024-03-01T12:00:01+00:00", 1709294401),
+            ("15550001", 19.99, 6, "Restaurante", "2024-03-01T12:00:02+00:00", 1709294402),
+        ],
+    )
+    conn.execute(
+        "INSERT INTO deposits (user, amount, source, ts_utc, ts_epoch) VALUES (?, ?, ?, ?, ?)",
+        ("15550001", 1200.5, "Salario", "2024-03-01T12:00:00+00:00", 1709294400),
+    )
+    conn.execute("INSERT INTO sessions (user, state, amount) VALUES (?, ?, ?)", ("15550001", "awaiting_category", 12.34))
+    conn.commit()
+    conn.close()
+
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    sys.path.insert(0, str(ROOT))
+    try:
+        yield importlib.import_module("app")
+    finally:
+        os.chdir(cwd)
@@ -0,0 +1,50 @@
+# Escritor write-behind: colapso de upserts de sesión dentro de un lote y
+# reintento fila por fila cuando una fila tumba el lote.
+import sqlite3
+from concurrent.futures import Future
+
+def _item(sql, params):
+    return (sql, params, Future())
+
+def _expense(user, cents):
+    return (user, cents, 6, "Restaurante", "2024-03-02T12:00:00+00:00", 1709380800)
+
+def _session_row(app, user):
+    return app.CONN.execute("SELECT state, amount_cents FROM sessions WHERE user = ?", (user,)).fetchone()
+
+def test_session_upserts_collapse_to_the_last_one(app):
+    user = "15550201"
+    batch = [
+        _item(app.SQL_UPSERT_SESSION, (user, "awaiting_amount", None)),
+        _item(app.SQL_UPSERT_SESSION, (user, "awaiting_category", 700)),
+        _item(app.SQL_UPSERT_SESSION, (user, "idle", None)),
+    ]
+    before = app.CONN.total_changes
+    app._write_batch(batch)
+    assert app.CONN.total_changes - before == 1  # una sola fila escrita
+    assert _session_row(app, user) == ("idle", None)
+    assert all(fut.result(timeout=0) is None for _, _, fut in batch)
+
+def test_bad_row_fails_alone_and_last_session_state_wins(app):
+    user = "15550202"
+    batch = [
+        _item(app.SQL_UPSERT_SESSION, (user, "awaiting_amount", None)),
+        _item(app.SQL_UPSERT_SESSION, (user, "awaiting_category", 1250)),
+        _item(app.SQL_INSERT_EXPENSE, _expense(user, 1250)),
+        _item(app.SQL_INSERT_EXPENSE, _expense(None, 999)),  # user NOT NULL
+        _item(app.SQL_INSERT_EXPENSE, _expense(user, 300)),
+        _item(app.SQL_UPSERT_SESSION, (user, "awaiting_category", 500)),
+    ]
+    bad = batch[3][2]
+    app._write_batch(batch)
+
+    assert isinstance(bad.exception(timeout=0), sqlite3.IntegrityError)
+    for _, _, fut in batch:
+        if fut is not bad:
+            assert fut.result(timeout=0) is None
+    assert _session_row(app, user) == ("awaiting_category", 500)
+    rows = app.CONN.execute(
+        "SELECT amount_cents FROM expenses WHERE user = ? ORDER BY id", (user,)
+    ).fetchall()
+    assert rows == [(1250,), (300,)]
+    assert app.CONN.execute("SELECT COUNT(*) FROM expenses WHERE amount_cents = 999").fetchone()[0] == 0
@@ -0,0 +1,83 @@
+# Despacho de mensajes: parse_resumen_args igual al if/elif original y comandos
+# exactos por encima del estado de la sesión.
+from datetime import datetime, timezone
+
+import pytest
+
+def _baseline_resumen_args(parts, categories):
+    # copia del árbol if/elif de la versión original (rama "resumen <args>");
+    # days None = mes actual
+    category, days = None, None
+    if len(parts) == 1:
+        p1 = parts[0]
+        if p1 in {"7", "15", "30"}:
+            days = int(p1)
+        elif p1 in categories:
+            category = p1
+    elif len(parts) >= 2:
+        p1, p2 = parts[0], parts[1]
+        if p1 in categories:
+            category = p1
+            if p2 in {"7", "15", "30"}:
+                days = int(p2)
+        elif p1 in {"7", "15", "30"}:
+            days = int(p1)
+    return category, days
+
+@pytest.mark.parametrize("parts, expected", [
+    ([], (None, None)),
+    (["7"], (None, 7)),
+    (["15"], (None, 15)),
+    (["mes"], (None, None)),
+    (["3"], ("3", None)),
+    (["3", "7"], ("3", 7)),
+    (["7", "30"], ("7", 30)),
+    (["30", "x"], (None, 30)),
+    (["zz"], (None, None)),
+])
+def test_parse_resumen_args_matches_baseline(app, parts, expected):
+    assert _baseline_resumen_args(parts, app.CATEGORIES) == expected
+    assert app.parse_resumen_args(parts) == expected
+
+@pytest.fixture
+def sent(app, monkeypatch):
+    out = []
+    monkeypatch.setattr(app, "send_whatsapp_text", lambda to, text: out.append(text) or True)
+    monkeypatch.setattr(app, "send_whatsapp_category_list", lambda to: True)
+    return out
+
+def _dispatch(app, user, text):
+    app.dispatch_message(user, app.get_session(user), text, None, datetime.now(timezone.utc))
+
+@pytest.mark.parametrize("word", ["reset", "cancelar"])
+def test_reset_wins_over_awaiting_category(app, sent, word):
+    user = "15550101"
+    app.set_session(user, "awaiting_category", 1234)
+    _dispatch(app, user, f"  {word.upper()} ")
+    assert app.get_session(user) == {"state": "idle", "amount_cents": None}
+    assert sent == [app.RESET_TEXT]
+
+def test_trigger_wins_over_awaiting_income_source(app, sent):
+    user = "15550102"
+    app.set_session(user, "awaiting_income_source", 50000)
+    _dispatch(app, user, "gasto")
+    assert app.get_session(user)["state"] == "awaiting_amount"
+
+def test_prefix_command_wins_over_awaiting_amount(app, sent, monkeypatch):
+    user = "15550103"
+    calls = []
+    monkeypatch.setitem(app._PREFIX_COMMANDS, "resumen", lambda u, sess, args: calls.append(args))
+    app.set_session(user, "awaiting_amount", None)
+    _dispatch(app, user, "Resumen 3 7")
+    assert calls == [["3", "7"]]
+    assert app.get_session(user)["state"] == "awaiting_amount"
+
+def test_state_handler_runs_without_command(app, sent):
+    user = "15550104"
+    app.set_session(user, "awaiting_amount", None)
+    _dispatch(app, user, "12,50")
+    assert app.get_session(user) == {"state": "awaiting_category", "amount_cents": 1250}
+
+def test_idle_without_command_gets_help(app, sent):
+    _dispatch(app, "15550105", "hola")
+    assert sent == [app.HELP_TEXT]
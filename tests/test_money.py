@@ -0,0 +1,61 @@
+# Montos en centavos: migración REAL -> amount_cents y aritmética de to_cents/format_usd.
+# El fixture app (conftest.py) importa app sobre una base con el esquema original.
+import pytest
+
+def test_migration_converts_amounts_to_cents(app):
+    assert app.CONN.execute("PRAGMA user_version").fetchone()[0] == app.SCHEMA_VERSION
+    for table in ("expenses", "deposits", "sessions"):
+        cols = [row[1] for row in app.CONN.execute(f"PRAGMA table_info({table})")]
+        assert "amount_cents" in cols and "amount" not in cols
+
+    rows = app.CONN.execute("SELECT id, amount_cents FROM expenses WHERE user = ? ORDER BY id", ("15550001",)).fetchall()
+    assert rows == [(1, 10), (2, 20), (3, 1999)]
+    assert app.CONN.execute("SELECT amount_cents FROM deposits WHERE user = ?", ("15550001",)).fetchall() == [(120050,)]
+    assert app.get_session("15550001") == {"state": "awaiting_category", "amount_cents": 1234}
+
+    # 0.1 + 0.2 exacto en centavos
+    assert app.get_total_for_category_in_range("15550001", "1", 0, 2**40) == 30
+    assert app.get_income_total_in_range("15550001", 0, 2**40) == 120050
+
+def test_migration_keeps_indexes_and_is_idempotent(app):
+    app.migrate_db()
+    indexes = {row[0] for row in app.CONN.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert set(app.INDEXES) <= indexes
+    assert app.CONN.execute("SELECT COUNT(*) FROM expenses WHERE user = ?", ("15550001",)).fetchone()[0] == 3
+
+@pytest.mark.parametrize("value, cents", [
+    (0, 0),
+    ("0", 0),
+    (0.005, 1),
+    ("0.005", 1),
+    ("-0.005", -1),
+    ("-12.34", -1234),
+    (0.1 + 0.2, 30),
+    ("1200.5", 120050),
+])
+def test_to_cents(app, value, cents):
+    assert app.to_cents(value) == cents
+
+@pytest.mark.parametrize("cents, text", [
+    (0, "0.00"),
+    (1, "0.01"),
+    (-1, "-0.01"),
+    (-5, "-0.05"),
+    (-100, "-1.00"),
+    (-123456, "-1234.56"),
+    (123456, "1234.56"),
+])
+def test_format_usd(app, cents, text):
+    assert app.format_usd(cents) == text
+
+@pytest.mark.parametrize("text, cents", [
+    ("12,5", 1250),
+    ("$25.50", 2550),
+    ("0.005", 1),
+    ("abc", None),
+    ("10000000", 1_000_000_000),
+    ("10000000.01", None),
+    ("99999999999999999999", None),
+])
+def test_parse_amount_cents(app, text, cents):
+    assert app.parse_amount_cents(text) == cents
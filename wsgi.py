@@ -0,0 +1,2 @@
+# wsgi.py — punto de entrada para gunicorn: gunicorn -c gunicorn.conf.py wsgi:app
+from app import app  # noqa: F401